@@ -6,4 +6,6 @@ pip install wandb==0.17.5
 pip install torchaudio==2.4.0
 pip install einops==0.8.0
 pip install accelerate==0.33.0
-pip install rotary-embedding-torch
\ No newline at end of file
+pip install rotary-embedding-torch
+# Optional. Only for inference.py --quantize
+pip install torchao==0.4.0
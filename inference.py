@@ -16,6 +16,7 @@ def inference(args):
 
     # Arguments
     model_name = args.model_name
+    quantize = args.quantize
 
     # Default parameters
     sr = 44100
@@ -28,9 +29,20 @@ def inference(args):
     checkpoint_path = Path("checkpoints", "train", model_name, "latest.pth")
 
     model = get_model(model_name)
+
+    if quantize and not hasattr(model, "transformers"):
+        raise ValueError("--quantize only supports BSRoformer models, got {}.".format(model_name))
+
     model.load_state_dict(torch.load(checkpoint_path))
     model.to(device)
 
+    if quantize:
+        # Int8 weight-only quantization of the attention and MLP linears in 
+        # the transformers. Norms and rotary are kept in full precision. 
+        # Requires torchao==0.4.0, see env.sh.
+        from torchao.quantization import quantize_, int8_weight_only
+        quantize_(model.transformers, int8_weight_only())
+
     # Load audio. Change this path to your favorite song.
     root = "/datasets/musdb18hq/test"
     mixture_path = Path(root, "Al James - Schoolboy Facination", "mixture.wav") 
@@ -55,6 +67,7 @@ if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
     parser.add_argument('--model_name', type=str, default="UNet")
+    parser.add_argument('--quantize', action='store_true', help="Int8 weight-only quantization of BSRoformer transformers. Requires torchao.")
     args = parser.parse_args()
 
     inference(args)
\ No newline at end of file
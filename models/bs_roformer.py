@@ -1,12 +1,22 @@
+import contextlib
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.nn import Module, ModuleList
-import torchaudio
-from einops import rearrange
+from torch.nn.attention import SDPBackend, sdpa_kernel
+from torch.utils.checkpoint import checkpoint
 import numpy as np
 from rotary_embedding_torch import RotaryEmbedding
 
+try:
+    # Fused Triton rotary kernel and FlashAttention kernel. Optional.
+    from flash_attn import flash_attn_func
+    from flash_attn.layers.rotary import apply_rotary_emb_qkv_
+except ImportError:
+    flash_attn_func = None
+    apply_rotary_emb_qkv_ = None
+
 from models.fourier import Fourier
 
 
@@ -30,13 +40,18 @@ class BSRoformer(Fourier):
         time_stacks: int = 4,
         depth: int = 12,
         dim: int = 384,
-        n_heads: int = 12
+        n_heads: int = 12,
+        bf16: bool = False,
+        compile_blocks: bool = False,
+        grad_checkpoint: bool = False
     ):
         super().__init__(n_fft, hop_length)
 
         self.depth = depth
         self.dim = dim
         self.n_heads = n_heads
+        self.bf16 = bf16
+        self.grad_checkpoint = grad_checkpoint
 
         self.cmplx_num = 2
         self.audio_channels = 2
@@ -57,16 +72,32 @@ class BSRoformer(Fourier):
             band_output_dims=band_input_dims
         )
 
-        time_rotary_embed = RotaryEmbedding(dim=self.head_dim)
-        freq_rotary_embed = RotaryEmbedding(dim=self.head_dim)
+        # Time and frequency transformers share the same rotary frequencies
+        self.rotary_embed = RotaryEmbedding(dim=self.head_dim)
+
+        # Rotary tables cached across forwards. Only grow for a longer 
+        # sequence. Non-persistent so that checkpoints are unchanged.
+        self.register_buffer("rotary_cos", torch.empty(0, self.head_dim // 2), persistent=False)
+        self.register_buffer("rotary_sin", torch.empty(0, self.head_dim // 2), persistent=False)
 
         self.transformers = ModuleList([])
 
         for _ in range(self.depth):
             self.transformers.append(nn.ModuleList([
-                TransformerBlock(dim=self.dim, n_heads=self.n_heads, rotary_embed=time_rotary_embed),
-                TransformerBlock(dim=self.dim, n_heads=self.n_heads, rotary_embed=freq_rotary_embed)
+                TransformerBlock(dim=self.dim, n_heads=self.n_heads),
+                TransformerBlock(dim=self.dim, n_heads=self.n_heads)
             ]))
+
+        if compile_blocks:
+            # Fuse norms, activations and residuals of each block. Compiled in 
+            # place so that state_dict keys are unchanged. Dynamic shapes 
+            # because (b*f) and (b*t) change with batch size.
+            self.band_split.compile(dynamic=True)
+            self.band_combine.compile(dynamic=True)
+
+            for t_transformer, f_transformer in self.transformers:
+                t_transformer.compile(dynamic=True)
+                f_transformer.compile(dynamic=True)
         
     def forward(self, mixture):
         """Separation model.
@@ -100,28 +131,52 @@ class BSRoformer(Fourier):
         x = torch.view_as_real(x)
         # shape: (b, c, T, F, z)
 
-        x = rearrange(x, 'b c (t m) F z -> b t (m F c z)', m=self.time_stacks)
+        x = x.unflatten(2, (-1, self.time_stacks)).permute(0, 2, 3, 4, 1, 5).flatten(start_dim=2)
         # shape: (b, t, m*F*c*z)
 
-        x = self.band_split(x)
-        # shape: (b, t, f, d)
+        # Band nets and transformers run in bfloat16. STFT, ISTFT and the 
+        # complex mask stay in float32. Only sm80+ GPUs have native bfloat16. 
+        # When disabled, an autocast context set by the caller is kept.
+        bf16 = self.bf16 and x.is_cuda and torch.cuda.get_device_capability(x.device) >= (8, 0)
 
-        for t_transformer, f_transformer in self.transformers:
+        if bf16:
+            amp_context = torch.autocast(device_type=x.device.type, dtype=torch.bfloat16)
+        else:
+            amp_context = contextlib.nullcontext()
 
-            x = rearrange(x, 'b t f d -> (b f) t d')
+        with amp_context:
 
-            x = t_transformer(x)
+            # Keep the residual stream of the transformers in float32. BandSplit 
+            # returns a permuted view of band-major memory. Make the stream 
+            # contiguous in (b, t, f, d), also when it is float32 already.
+            x = self.band_split(x).float().contiguous()
+            # shape: (b, t, f, d)
 
-            x = rearrange(x, '(b f) t d -> (b t) f d', b=batch_size)
+            # Rotary tables are computed once in float32 and shared by all blocks
+            t_cos, t_sin = self.rotary_cos_sin(x.shape[1])
+            f_cos, f_sin = self.rotary_cos_sin(x.shape[2])
 
-            x = f_transformer(x)
+            time_bins = x.shape[1]
 
-            x = rearrange(x, '(b t) f d -> b t f d', b=batch_size)
+            # The residual stream stays in the (b, t, f, d) memory layout. The 
+            # time transformer gets a transposed view instead of a copy.
+            for t_transformer, f_transformer in self.transformers:
 
-        x = self.band_combine(x)
-        # shape: (b, t, m*F*c*z)
+                if self.grad_checkpoint and torch.is_grad_enabled():
+                    # Only keep the input of each pair and recompute the 
+                    # activations in backward
+                    x = checkpoint(self.transformer_pair, t_transformer, f_transformer, x, t_cos, t_sin, f_cos, f_sin, use_reentrant=False)
+                else:
+                    x = self.transformer_pair(t_transformer, f_transformer, x, t_cos, t_sin, f_cos, f_sin)
+                # shape: (b, t, f, d)
+
+            x = self.band_combine(x)
+            # shape: (b, t, m*F*c*z)
 
-        x = rearrange(x, 'b t (m F c z) -> b c (t m) F z', m=self.time_stacks, c=self.audio_channels, z=self.cmplx_num)
+        x = x.float()
+
+        x = x.view(batch_size, time_bins, self.time_stacks, -1, self.audio_channels, self.cmplx_num)
+        x = x.permute(0, 4, 1, 2, 3, 5).flatten(start_dim=2, end_dim=3)
         # (b, c, T, F, z)
         
         x = torch.view_as_complex(x)
@@ -136,6 +191,64 @@ class BSRoformer(Fourier):
 
         return output
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Old checkpoints stored identical rotary freqs in every attention: 
+        # transformers.{i}.{j}.att.rotary_embed.freqs
+        old_keys = [key for key in state_dict if key.startswith(prefix + "transformers.") and key.endswith(".att.rotary_embed.freqs")]
+
+        for key in old_keys:
+            freqs = state_dict.pop(key)
+            shared_freqs = state_dict.setdefault(prefix + "rotary_embed.freqs", freqs)
+
+            if not torch.equal(freqs, shared_freqs):
+                raise ValueError("Rotary freqs differ across blocks in {}, cannot be shared.".format(key))
+
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+        # Rebuild the cached rotary tables from the loaded freqs
+        self.rotary_cos = self.rotary_cos.new_empty(0, self.head_dim // 2)
+        self.rotary_sin = self.rotary_sin.new_empty(0, self.head_dim // 2)
+
+    def transformer_pair(self, t_transformer, f_transformer, x, t_cos, t_sin, f_cos, f_sin):
+        r"""Time transformer followed by frequency transformer. The frequency 
+        transformer attends over the output of the time transformer, so the 
+        two attentions can not be packed into one attention call.
+
+        Args:
+            x: (b, t, f, d)
+
+        Outputs:
+            output: (b, t, f, d)
+        """
+
+        x = t_transformer(x.transpose(1, 2), t_cos, t_sin).transpose(1, 2)
+        output = f_transformer(x, f_cos, f_sin)
+
+        return output
+
+    def rotary_cos_sin(self, seq_len):
+        r"""Float32 rotary tables of a sequence, sliced from the rotary_cos and 
+        rotary_sin buffers. The buffers are only rebuilt for a longer seq_len, 
+        or after a cast of the model such as .half().
+
+        Outputs:
+            cos: (seq_len, head_dim // 2)
+            sin: (seq_len, head_dim // 2)
+        """
+
+        if seq_len > self.rotary_cos.shape[0] or self.rotary_cos.dtype != torch.float32:
+
+            # Build normal tensors even under torch.inference_mode(), so that 
+            # the buffers can still be used by a later forward with grad.
+            with torch.inference_mode(False):
+                max_len = max(seq_len, self.rotary_cos.shape[0])
+                t = torch.arange(max_len, device=self.rotary_embed.freqs.device, dtype=torch.float32)
+                freqs = t[:, None] * self.rotary_embed.freqs.float()
+                self.rotary_cos = freqs.cos()
+                self.rotary_sin = freqs.sin()
+
+        return self.rotary_cos[0 : seq_len], self.rotary_sin[0 : seq_len]
+
     def process_image(self, x):
 
         B, C, T, Freq = x.shape
@@ -163,8 +276,130 @@ class RMSNorm(torch.nn.Module):
         self.weight = nn.Parameter(torch.ones(dim))
 
     def forward(self, x):
-        norm_x = torch.mean(x ** 2, dim=-1, keepdim=True)
-        output = x * torch.rsqrt(norm_x + self.eps) * self.weight
+        output = F.rms_norm(x, normalized_shape=(x.shape[-1],), weight=self.weight, eps=self.eps)
+        return output
+
+
+def group_bands(band_dims: list[int]) -> list[tuple[int, int, int, int]]:
+    r"""Group consecutive bands with the same dim.
+
+    Args:
+        band_dims: dims of all bands
+
+    Returns:
+        groups: list of (band_begin, band_end, offset, band_dim), where offset 
+            is the start position of the group in the concatenated bands
+    """
+
+    groups = []
+    band_begin = 0
+    offset = 0
+
+    for band_end in range(1, len(band_dims) + 1):
+
+        if band_end < len(band_dims) and band_dims[band_end] == band_dims[band_begin]:
+            continue
+
+        band_dim = int(band_dims[band_begin])
+        groups.append((band_begin, band_end, offset, band_dim))
+        offset += (band_end - band_begin) * band_dim
+        band_begin = band_end
+
+    return groups
+
+
+def pack_band_nets(
+    state_dict: dict, 
+    prefix: str, 
+    band_groups: list[tuple[int, int, int, int]], 
+    shared_layers: dict[int, str], 
+    grouped_layers: dict[int, str]
+) -> None:
+    r"""Convert parameters of old checkpoints with one nn.Sequential per band, 
+    i.e., band_nets.{band}.{layer}.weight / bias, into packed BandLinear and 
+    BandRMSNorm parameters in place.
+
+    Args:
+        state_dict: state dict being loaded
+        prefix: prefix of the BandSplit / BandCombine module
+        band_groups: output of group_bands()
+        shared_layers: {old layer index: new name} of layers packed over all bands
+        grouped_layers: {old layer index: new ModuleList name} of layers packed 
+            per group of bands
+    """
+
+    old_prefix = prefix + "band_nets."
+
+    if not any(key.startswith(old_prefix) for key in state_dict):
+        return
+
+    def pop(band, layer, name):
+        return state_dict.pop("{}{}.{}.{}".format(old_prefix, band, layer, name))
+
+    def pack(bands, layer, new_prefix):
+        weights = [pop(band, layer, "weight") for band in bands]
+
+        if weights[0].ndim == 2:
+            # nn.Linear: weight (o, i) -> (n, i, o), bias (o,) -> (n, 1, o)
+            state_dict[new_prefix + "weight"] = torch.stack([w.T for w in weights])
+            state_dict[new_prefix + "bias"] = torch.stack([pop(band, layer, "bias") for band in bands])[:, None, :]
+        else:
+            # RMSNorm: weight (d,) -> (n, 1, d)
+            state_dict[new_prefix + "weight"] = torch.stack(weights)[:, None, :]
+
+    bands_num = band_groups[-1][1]
+
+    for layer, name in shared_layers.items():
+        pack(range(bands_num), layer, "{}{}.".format(prefix, name))
+
+    for layer, name in grouped_layers.items():
+        for group, (band_begin, band_end, _, _) in enumerate(band_groups):
+            pack(range(band_begin, band_end), layer, "{}{}.{}.".format(prefix, name, group))
+
+
+class BandLinear(Module):
+    def __init__(self, bands_num: int, in_dim: int, out_dim: int):
+        r"""Independent linear layers of bands_num bands. Weights of all bands 
+        are packed into one parameter and computed with one batched matmul."""
+        super().__init__()
+
+        self.weight = nn.Parameter(torch.empty(bands_num, in_dim, out_dim))
+        self.bias = nn.Parameter(torch.empty(bands_num, 1, out_dim))
+
+        # Same initialization as nn.Linear
+        bound = 1. / np.sqrt(in_dim)
+        nn.init.uniform_(self.weight, -bound, bound)
+        nn.init.uniform_(self.bias, -bound, bound)
+
+    def forward(self, x):
+        r"""The bias is added inside the matmul.
+
+        Args:
+            x: (f, l, i), where l = b*t
+
+        Outputs:
+            output: (f, l, o)
+        """
+        output = torch.baddbmm(self.bias, x, self.weight)
+        return output
+
+
+class BandRMSNorm(Module):
+    def __init__(self, bands_num: int, dim: int, eps: float = 1e-6):
+        r"""Independent RMSNorm of bands_num bands."""
+        super().__init__()
+        self.eps = eps
+        self.weight = nn.Parameter(torch.ones(bands_num, 1, dim))
+
+    def forward(self, x):
+        r"""
+        Args:
+            x: (f, l, d)
+
+        Outputs:
+            output: (f, l, d)
+        """
+        output = F.rms_norm(x, normalized_shape=(x.shape[-1],), eps=self.eps) * self.weight
         return output
 
 
@@ -178,43 +413,74 @@ class BandSplit(Module):
         super().__init__()
         
         self.band_input_dims = band_input_dims
-        self.band_nets = ModuleList([])
-
-        for in_dim in band_input_dims:
-
-            net = nn.Sequential(
-            
-                # No Norm for the first layer
-                nn.Linear(in_dim, dim),
-                nn.GELU(),
-
-                RMSNorm(dim),
-                nn.Linear(dim, dim),
-                nn.GELU(),
-
-                RMSNorm(dim),
-                nn.Linear(dim, dim)
-            )
+        self.band_groups = group_bands(band_input_dims)
+        bands_num = len(band_input_dims)
+
+        # The first layer has different input dims across bands. Consecutive 
+        # bands with the same input dim share one packed layer. No Norm for 
+        # the first layer.
+        self.in_layers = ModuleList([
+            BandLinear(band_end - band_begin, in_dim, dim) 
+            for band_begin, band_end, _, in_dim in self.band_groups
+        ])
+
+        self.net = nn.Sequential(
+            nn.GELU(),
+
+            BandRMSNorm(bands_num, dim),
+            BandLinear(bands_num, dim, dim),
+            nn.GELU(),
+
+            BandRMSNorm(bands_num, dim),
+            BandLinear(bands_num, dim, dim)
+        )
 
-            self.band_nets.append(net)
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Old checkpoints: band_nets.{band}.{0: Linear, 2: RMSNorm, 3: Linear, 5: RMSNorm, 6: Linear}
+        pack_band_nets(
+            state_dict=state_dict, 
+            prefix=prefix, 
+            band_groups=self.band_groups, 
+            shared_layers={2: "net.1", 3: "net.2", 5: "net.4", 6: "net.5"}, 
+            grouped_layers={0: "in_layers"}
+        )
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
     def forward(self, x):
         r"""
 
         Args:
-            x: (m, t, m*F*c*z)
+            x: (b, t, m*F*c*z)
 
         Outputs:
-            output: (m, t, f, d)
+            output: (b, t, f, d)
         """
-        band_xs = torch.split(x, split_size_or_sections=self.band_input_dims, dim=-1)
+
+        B, T, _ = x.shape
+
+        x = x.flatten(start_dim=0, end_dim=1)
+        # shape: (l, m*F*c*z)
 
         outputs = []
-        for x, net in zip(band_xs, self.band_nets):
-            output = net(x)
+        for (band_begin, band_end, offset, in_dim), layer in zip(self.band_groups, self.in_layers):
+            bands_num = band_end - band_begin
+            band_x = x[:, offset : offset + bands_num * in_dim].unflatten(-1, (bands_num, in_dim)).transpose(0, 1)
+            # shape: (n, l, k)
+            
+            output = layer(band_x)
             outputs.append(output)
 
-        return torch.stack(outputs, dim=2)
+        # Bands are kept as the leading dim so that all layers are batched 
+        # matmuls without permutes in between.
+        x = torch.cat(outputs, dim=0)
+        # shape: (f, l, d)
+
+        x = self.net(x)
+
+        x = x.unflatten(1, (B, T)).permute(1, 2, 0, 3)
+        # shape: (b, t, f, d)
+
+        return x
 
 
 class BandCombine(Module):
@@ -227,25 +493,38 @@ class BandCombine(Module):
         super().__init__()
         
         self.band_output_dims = band_output_dims
-        self.band_nets = ModuleList([])
+        self.band_groups = group_bands(band_output_dims)
+        bands_num = len(band_output_dims)
 
-        for out_dim in band_output_dims:
+        self.net = nn.Sequential(
+            BandRMSNorm(bands_num, dim),
+            BandLinear(bands_num, dim, dim),
+            nn.GELU(),
 
-            net = nn.Sequential(
+            BandRMSNorm(bands_num, dim),
+            BandLinear(bands_num, dim, dim),
+            nn.GELU(),
 
-                RMSNorm(dim),
-                nn.Linear(dim, dim),
-                nn.GELU(),
-
-                RMSNorm(dim),
-                nn.Linear(dim, dim),
-                nn.GELU(),
-
-                RMSNorm(dim),
-                nn.Linear(dim, out_dim)
-            )
+            BandRMSNorm(bands_num, dim)
+        )
 
-            self.band_nets.append(net)
+        # The last layer has different output dims across bands. Consecutive 
+        # bands with the same output dim share one packed layer.
+        self.out_layers = ModuleList([
+            BandLinear(band_end - band_begin, dim, out_dim) 
+            for band_begin, band_end, _, out_dim in self.band_groups
+        ])
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Old checkpoints: band_nets.{band}.{0: RMSNorm, 1: Linear, 3: RMSNorm, 4: Linear, 6: RMSNorm, 7: Linear}
+        pack_band_nets(
+            state_dict=state_dict, 
+            prefix=prefix, 
+            band_groups=self.band_groups, 
+            shared_layers={0: "net.0", 1: "net.1", 3: "net.3", 4: "net.4", 6: "net.6"}, 
+            grouped_layers={7: "out_layers"}
+        )
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
     def forward(self, x):
         r"""
@@ -257,14 +536,41 @@ class BandCombine(Module):
             output: (b, t, m*F*c*z)
         """
         
-        band_xs = torch.unbind(x, dim=2)
+        B, T, _, _ = x.shape
+
+        x = x.permute(2, 0, 1, 3).flatten(start_dim=1, end_dim=2)
+        # shape: (f, l, d)
+
+        x = self.net(x)
 
         outputs = []
-        for x, net in zip(band_xs, self.band_nets):
-            output = net(x)
-            outputs.append(output)
+        for (band_begin, band_end, _, _), layer in zip(self.band_groups, self.out_layers):
+            output = layer(x[band_begin : band_end])
+            # shape: (n, l, k)
+
+            outputs.append(output.transpose(0, 1).flatten(start_dim=1))
+
+        x = torch.cat(outputs, dim=-1)
+        # shape: (l, m*F*c*z)
+
+        return x.unflatten(0, (B, T))
+
 
-        return torch.cat(outputs, dim=-1)
+def apply_rotary_emb(x: torch.Tensor, cos: torch.Tensor, sin: torch.Tensor) -> torch.Tensor:
+    r"""Rotate adjacent pairs of channels. Same as rotate_queries_or_keys() of 
+    RotaryEmbedding but with precomputed tables.
+
+    Args:
+        x: (..., d)
+        cos: (..., d // 2), broadcastable to x
+        sin: (..., d // 2), broadcastable to x
+
+    Outputs:
+        output: (..., d)
+    """
+    x1, x2 = x.unflatten(-1, (-1, 2)).unbind(dim=-1)
+    output = torch.stack((x1 * cos - x2 * sin, x1 * sin + x2 * cos), dim=-1)
+    return output.flatten(start_dim=-2).type_as(x)
 
 
 class MLP(nn.Module):
@@ -284,14 +590,14 @@ class MLP(nn.Module):
 
 class Attention(nn.Module):
 
-    def __init__(self, dim: int, n_heads: int, rotary_embed: RotaryEmbedding):
+    def __init__(self, dim: int, n_heads: int):
         super().__init__()
         
         assert dim % n_heads == 0
 
         self.n_heads = n_heads
         self.dim = dim
-        self.rotary_embed = rotary_embed
+        self.head_dim = dim // n_heads
 
         self.flash = hasattr(torch.nn.functional, 'scaled_dot_product_attention')
         assert self.flash, "Must have flash attention."
@@ -299,39 +605,93 @@ class Attention(nn.Module):
         self.c_attn = nn.Linear(dim, 3 * dim, bias=False)
         self.c_proj = nn.Linear(dim, dim, bias=False)
         
-    def forward(self, x):
-        r"""
+    def forward(self, x, cos, sin):
+        r"""Attention along dim 2 of x. Dim 1 is folded into the batch, so x 
+        may be a transposed view.
+
         Args:
-            x: (b, t, h*d)
+            x: (b, n, t, h*d)
+            cos: (t, d // 2)
+            sin: (t, d // 2)
 
         Constants:
             b: batch_size
+            n: number of sequences per example
             t: time steps
             r: 3
             h: heads_num
             d: heads_dim
         """
-        B, T, C = x.size()
+        B, N, T, C = x.size()
+
+        # View of the c_attn output, no copy
+        qkv = self.c_attn(x).view(B * N, T, 3, self.n_heads, self.head_dim)
+        # shape: (b*n, t, r, h, d)
+
+        if apply_rotary_emb_qkv_ is not None and qkv.is_cuda:
 
-        q, k, v = rearrange(self.c_attn(x), 'b t (r h d) -> r b h t d', r=3, h=self.n_heads)
-        # q, k, v: (b, h, t, d)
+            # The fused kernel requires the tables in the dtype of qkv
+            if cos.dtype != qkv.dtype:
+                cos, sin = cos.to(qkv.dtype), sin.to(qkv.dtype)
 
-        q = self.rotary_embed.rotate_queries_or_keys(q)
-        k = self.rotary_embed.rotate_queries_or_keys(k)
+            # Rotate q and k in place in one kernel
+            apply_rotary_emb_qkv_(qkv, cos, sin, interleaved=True)
+
+            q, k, v = qkv.unbind(dim=2)
+
+        else:
+
+            # Rotate q and k in one pass, reading them from qkv directly
+            qk = apply_rotary_emb(qkv[:, :, 0 : 2], cos[:, None, None, :], sin[:, None, None, :])
+
+            q, k = qk.unbind(dim=2)
+            v = qkv[:, :, 2]
+
+        # q, k, v: (b*n, t, h, d)
+
+        # Flash kernels need half precision inputs on sm80 and newer GPUs
+        flash_supported = (
+            q.is_cuda 
+            and q.dtype in (torch.float16, torch.bfloat16) 
+            and torch.cuda.get_device_capability(q.device) >= (8, 0)
+        )
 
-        if self.flash:
-            y = torch.nn.functional.scaled_dot_product_attention(q, k, v, attn_mask=None, dropout_p=0, is_causal=False)
+        if flash_attn_func is not None and flash_supported:
+            # FlashAttention takes the (b, t, h, d) layout without transposes
+            y = flash_attn_func(q, k, v)
+
+        elif self.flash:
+
+            if flash_supported:
+                # Require the Flash backend instead of silently falling back to 
+                # the memory efficient or math backends.
+                backends = [SDPBackend.FLASH_ATTENTION]
+            else:
+                backends = [SDPBackend.FLASH_ATTENTION, SDPBackend.EFFICIENT_ATTENTION, SDPBackend.MATH]
+
+            with sdpa_kernel(backends):
+                y = torch.nn.functional.scaled_dot_product_attention(
+                    q.transpose(1, 2), 
+                    k.transpose(1, 2), 
+                    v.transpose(1, 2), 
+                    attn_mask=None, 
+                    dropout_p=0, 
+                    is_causal=False,
+                    scale=self.head_dim ** -0.5
+                ).transpose(1, 2)
+
+        # y: (b*n, t, h, d)
         
-        y = rearrange(y, 'b h t d -> b t (h d)')
+        y = y.reshape(B, N, T, C)
 
         y = self.c_proj(y)
-        # shape: (b, t, h*d)
+        # shape: (b, n, t, h*d)
 
         return y
 
 
 class TransformerBlock(nn.Module):
-    def __init__(self, dim: int, n_heads: int, rotary_embed: RotaryEmbedding):
+    def __init__(self, dim: int, n_heads: int):
         
         super().__init__()
         self.dim = dim
@@ -339,14 +699,16 @@ class TransformerBlock(nn.Module):
         
         self.att_norm = RMSNorm(dim)
         self.ffn_norm = RMSNorm(dim)
-        self.att = Attention(dim=dim, n_heads=n_heads, rotary_embed=rotary_embed)
+        self.att = Attention(dim=dim, n_heads=n_heads)
         self.mlp = MLP(dim=dim)
         
 
     def forward(
         self,
         x: torch.Tensor,
+        cos: torch.Tensor,
+        sin: torch.Tensor,
     ):
-        h = x + self.att(self.att_norm(x))
+        h = x + self.att(self.att_norm(x), cos, sin)
         out = h + self.mlp(self.ffn_norm(h))
         return out
@@ -2,7 +2,6 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.nn import Module, ModuleList
-import torchaudio
 from einops import rearrange
 import numpy as np
 from rotary_embedding_torch import RotaryEmbedding
@@ -1,7 +1,6 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-import torchaudio
 from einops import rearrange
 
 
@@ -20,6 +19,10 @@ class Fourier(nn.Module):
         self.return_complex = return_complex
         self.normalized = normalized
 
+        # Created once and moved together with the model, instead of being 
+        # created on CPU and copied to the device in every stft() / istft().
+        self.register_buffer("window", torch.hann_window(self.n_fft), persistent=False)
+
     def stft(self, waveform):
         """
         Args:
@@ -37,7 +40,7 @@ class Fourier(nn.Module):
             input=x, 
             n_fft=self.n_fft,
             hop_length=self.hop_length,
-            window=torch.hann_window(self.n_fft).to(x.device),
+            window=self.window,
             normalized=self.normalized,
             return_complex=self.return_complex
         )
@@ -65,7 +68,7 @@ class Fourier(nn.Module):
             input=x, 
             n_fft=self.n_fft,
             hop_length=self.hop_length,
-            window=torch.hann_window(self.n_fft).to(x.device),
+            window=self.window,
             normalized=self.normalized,
         )
         # shape: (batch_size * channels_num, samples_num)
@@ -1,7 +1,6 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-import torchaudio
 from einops import rearrange
 import numpy as np
 
@@ -74,11 +73,11 @@ class UNet(Fourier):
 
         x = self.last_conv(x8)
 
-        x = rearrange(x, 'b (c k) t f -> b c t f k', k=self.cmplx_num).contiguous()
-        mask = torch.view_as_complex(x)
-        
         # Unprocess a spectrum to the original shape.
-        mask = self.unprocess_image(mask, time_steps=complex_sp.shape[2])
+        x = self.unprocess_image(x, time_steps=complex_sp.shape[2])
+        # shape: (B, C, T, F, K)
+
+        mask = torch.view_as_complex(x)
 
         sep_stft = mask * complex_sp
 
@@ -109,17 +108,21 @@ class UNet(Fourier):
         return output
 
     def unprocess_image(self, x, time_steps):
-        """Patch a spectrum to the original shape. E.g.,
+        """Patch a spectrum to the original shape and move the complex dim 
+        to the last. E.g.,
         
         Args:
-            x: E.g., (B, C, 208, 1024)
+            x: E.g., (B, C*K, 208, 1024)
         
         Outpus:
-            output: E.g., (B, C, 201, 1025)
+            output: E.g., (B, C, 201, 1025, K)
         """
-        x = F.pad(x, pad=(0, 1))
+        x = rearrange(x[:, :, 0 : time_steps, :], 'b (c k) t f -> b c t f k', k=self.cmplx_num)
 
-        output = x[:, :, 0 : time_steps, :]
+        # Padding the last frequency bin with cat also makes the complex dim 
+        # contiguous, so view_as_complex() needs no extra copy.
+        B, C, T, Freq, K = x.shape
+        output = torch.cat((x, x.new_zeros(B, C, T, 1, K)), dim=3)
 
         return output
 
@@ -89,11 +89,18 @@ def train(args):
     # Create checkpoints directory
     Path(checkpoints_dir).mkdir(parents=True, exist_ok=True)
 
+    # Copy the next batch to GPU while training on the current batch
+    train_batches = prefetch_to_device(
+        dataloader=train_dataloader, 
+        keys=["mixture", "vocals"], 
+        device=device
+    )
+
     # Train
-    for step, data in enumerate(tqdm(train_dataloader)):
+    for step, data in enumerate(tqdm(train_batches)):
 
-        mixture = data["mixture"].to(device)
-        target = data["vocals"].to(device)
+        mixture = data["mixture"]
+        target = data["vocals"]
 
         # Forward
         model.train()
@@ -172,6 +179,9 @@ def get_model(model_name):
             depth=12,
             dim=384,
             n_heads=12,
+            bf16=True,
+            compile_blocks=True,
+            grad_checkpoint=True,
         )
     elif model_name == "BSRoformer2":
         from models.bs_roformer2 import BSRoformer2
@@ -206,6 +216,41 @@ class InfiniteSampler:
             yield index
 
 
+def prefetch_to_device(dataloader: DataLoader, keys: list, device: str):
+    r"""Yield batches whose tensors of keys are already on device. The copy of 
+    the next batch runs on a side CUDA stream and overlaps with the 
+    computation on the current batch.
+    """
+
+    stream = torch.cuda.Stream(device=device)
+
+    def load(batches):
+        data = next(batches, None)
+        if data is not None:
+            with torch.cuda.stream(stream):
+                for key in keys:
+                    data[key] = data[key].to(device, non_blocking=True)
+        return data
+
+    batches = iter(dataloader)
+    next_data = load(batches)
+
+    while next_data is not None:
+
+        # Wait for the copy before the computation uses the batch
+        torch.cuda.current_stream(device).wait_stream(stream)
+        data = next_data
+
+        for key in keys:
+            # The memory is allocated on the side stream but used on the 
+            # current stream
+            data[key].record_stream(torch.cuda.current_stream(device))
+
+        next_data = load(batches)
+
+        yield data
+
+
 def warmup_lambda(step, warm_up_steps=1000):
     if step <= warm_up_steps:
         return step / warm_up_steps